@@ -4,7 +4,7 @@ from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from user.authentication import ProfileJWTAuthentication
 from user.decorators import premium_required, track_feature_usage
 
 from .models import CoverLetter
@@ -15,7 +15,7 @@ class CoverLetterViewSet(ModelViewSet):
     """ViewSet for managing cover letters."""
 
     serializer_class = CoverLetterSerializer
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
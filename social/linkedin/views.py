@@ -5,7 +5,7 @@ from rest_framework.authentication import SessionAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from user.authentication import ProfileJWTAuthentication
 
 from .models import FavoriteJob, IgnoredJob, Job
 from .permissions import HasPublicAPIKey
@@ -63,7 +63,7 @@ class JobViewSet(ReadOnlyModelViewSet):
 class FavoriteJobViewSet(ModelViewSet):
     """Simple ModelViewSet for managing user's favorite jobs - Create, Retrieve, Delete only."""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = FavoriteJobSerializer
 
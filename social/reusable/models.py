@@ -15,3 +15,23 @@ class BaseModel(models.Model):
 def get_network_model(class_name):
     models_module = importlib.import_module("network.models")
     return getattr(models_module, class_name)
+
+
+class JSONBMerge(models.Func):
+    """Merge a dict into a jsonb column on the database side (column || value).
+
+    Args:
+        field_name (str): name of the JSONField to merge into
+        data (dict): keys to add or overwrite
+    """
+
+    template = "(%(expressions)s::jsonb)"
+    arg_joiner = " || "
+    output_field = models.JSONField()
+
+    def __init__(self, field_name, data, **extra):
+        super().__init__(
+            models.F(field_name),
+            models.Value(data, output_field=models.JSONField()),
+            **extra,
+        )
@@ -0,0 +1,28 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# DRF's encoder handles the leftovers (Decimal, lazy strings, querysets, and
+# datetimes, so they keep DRF's formatting)
+_drf_default = JSONEncoder().default
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes with orjson. Types orjson doesn't know (Decimal,
+    lazy strings, datetimes) go through DRF's encoder, so they come out as
+    DRF renders them. Unlike DRF, NaN and Infinity are written as null
+    instead of raising.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        # orjson only knows a 2-space indent, let DRF handle indented output
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return orjson.dumps(
+            data,
+            default=_drf_default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+        )
@@ -0,0 +1,31 @@
+import threading
+
+from django.utils import timezone
+
+_request_local = threading.local()
+
+
+def request_now():
+    """Return the time the current request started at.
+
+    Read-only checks (expiry, remaining days) done many times per request can
+    share one timestamp. Outside a request it falls back to timezone.now().
+    """
+    now = getattr(_request_local, "now", None)
+    if now is None:
+        return timezone.now()
+    return now
+
+
+class RequestNowMiddleware:
+    """Store the request start time for request_now()."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _request_local.now = timezone.now()
+        try:
+            return self.get_response(request)
+        finally:
+            _request_local.now = None
@@ -44,6 +44,16 @@ app.conf.beat_schedule = {
         "task": "twitter.tasks.check_twitter_pages",
         "schedule": crontab(minute=0, hour="*/4"),
     },
+    "expire_premium_flags": {
+        "task": "user.tasks.expire_premium_flags",
+        "schedule": crontab(minute=5),
+    },
+    # Sends retries whose backoff has passed and emails left behind when a
+    # flush stopped on an SMTP error
+    "flush_email_outbox": {
+        "task": "user.tasks.flush_email_outbox",
+        "schedule": crontab(minute="*/1"),
+    },
     # "scan_ignored_jobs_for_tags": {
     #     "task": "linkedin.tasks.find_tags_in_ignored_jobs",
     #     "schedule": crontab(minute="*/5"),
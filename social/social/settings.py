@@ -51,6 +51,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "reusable.time.RequestNowMiddleware",
 ]
 
 ROOT_URLCONF = "social.urls"
@@ -120,6 +121,10 @@ CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "Asia/Tehran"
+# Payment webhooks get their own queue so crawler tasks can't delay them
+PAYMENT_WEBHOOK_QUEUE = "payments"
+# Outgoing emails are sent from their own queue as well
+EMAIL_QUEUE = "emails"
 
 
 CORS_ALLOW_ALL_ORIGINS = True
@@ -189,6 +194,9 @@ COIN_PAYMENT_BASE_URL = env.str(
     "COIN_PAYMENT_BASE_URL", default="https://coin-payment.m-gh.com"
 )
 COIN_PAYMENT_API_SECRET = env.str("COIN_PAYMENT_API_SECRET", default="")
+# Send a second invoice status request if the first takes longer than the delay
+COIN_PAYMENT_HEDGE_ENABLED = env.bool("COIN_PAYMENT_HEDGE_ENABLED", default=False)
+COIN_PAYMENT_HEDGE_DELAY = env.float("COIN_PAYMENT_HEDGE_DELAY", default=0.4)
 
 
 django.setup()  # we need setup django to have access to apps
@@ -264,7 +272,11 @@ if EMAIL_HOST_USER and ADMIN_EMAIL_LOG:
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "user.authentication.ProfileJWTAuthentication",
+    ],
+    "DEFAULT_RENDERER_CLASSES": [
+        "reusable.renderers.ORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
     ],
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.LimitOffsetPagination",
     "PAGE_SIZE": 10,
@@ -1,17 +1,47 @@
-import json
 import logging
+from collections import defaultdict
 
+import orjson
 from django import forms
 from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.db import transaction
 from django.utils import timezone
-from django.utils.html import format_html
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 
 from reusable.admins import ReadOnlyAdminDateFieldsMIXIN
+from reusable.models import JSONBMerge
 from . import models
-from .services import payment_service
+from .services import get_payment_service
+from .tasks import send_verification_email
 
 logger = logging.getLogger(__name__)
 
+# Rows fetched per round trip (and bucket flush interval) in check_payment_status
+CHECK_STATUS_CHUNK_SIZE = 500
+
+# Changelist cells are rendered once per row, so build the markup up front
+DAYS_REMAINING_HTML = '<span style="color: green;">%d days</span>'
+PAYMENT_LINK_HTML = '<a href="%s" target="_blank">Payment Link</a>'
+EXPIRED_SUBSCRIPTION_HTML = mark_safe('<span style="color: red;">Expired</span>')
+PAID_HTML = mark_safe('<span style="color: green;">✓ Paid</span>')
+EXPIRED_INVOICE_HTML = mark_safe('<span style="color: red;">✗ Expired</span>')
+PENDING_HTML = mark_safe('<span style="color: orange;">⏳ Pending</span>')
+NOT_APPLICABLE_HTML = mark_safe('<span style="color: gray;">- N/A</span>')
+
+
+def sync_metadata(old_status, synced_at):
+    """Metadata merged into an invoice after syncing it with the payment service."""
+    return JSONBMerge(
+        "metadata",
+        {
+            "last_sync_at": synced_at.isoformat(),
+            "sync_source": "admin_action",
+            "previous_status": old_status,
+        },
+    )
+
 
 class SubscriptionPlanForm(forms.ModelForm):
     """Custom form for SubscriptionPlan with better JSON handling."""
@@ -33,20 +63,26 @@ class SubscriptionPlanForm(forms.ModelForm):
 
         try:
             # Try to parse as JSON
-            parsed_features = json.loads(features_data)
+            parsed_features = orjson.loads(features_data)
             if not isinstance(parsed_features, list):
                 raise forms.ValidationError("Features must be a JSON array (list).")
             return parsed_features
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             raise forms.ValidationError(f"Invalid JSON format: {str(e)}")
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Convert existing features to JSON string for display
         if self.instance and self.instance.pk and self.instance.features:
-            self.fields["features"].initial = json.dumps(
-                self.instance.features, indent=2
-            )
+            self.fields["features"].initial = orjson.dumps(
+                self.instance.features, option=orjson.OPT_INDENT_2
+            ).decode()
+
+
+class ProfileChangeList(ChangeList):
+    def get_queryset(self, request, *args, **kwargs):
+        # The list never shows the free-text columns, the change form does
+        return super().get_queryset(request, *args, **kwargs).without_text()
 
 
 @admin.register(models.Profile)
@@ -61,7 +97,8 @@ class ProfileAdmin(ReadOnlyAdminDateFieldsMIXIN):
     )
     list_filter = ("is_email_verified", "created_at", "updated_at")
     search_fields = ("user__email", "user__username", "cell_number", "chat_id")
-    readonly_fields = ("verification_code", "verification_expires_at")
+    readonly_fields = ("verification_code_hash", "verification_expires_at")
+    actions = ["reset_verification_codes"]
 
     fieldsets = (
         (
@@ -73,7 +110,7 @@ class ProfileAdmin(ReadOnlyAdminDateFieldsMIXIN):
             {
                 "fields": (
                     "is_email_verified",
-                    "verification_code",
+                    "verification_code_hash",
                     "verification_expires_at",
                     "verification_attempts",
                 ),
@@ -82,12 +119,28 @@ class ProfileAdmin(ReadOnlyAdminDateFieldsMIXIN):
         ),
     )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_user()
+
+    def get_changelist(self, request, **kwargs):
+        return ProfileChangeList
+
+    def reset_verification_codes(self, request, queryset):
+        codes = queryset.reset_verification_codes()
+        for profile, code in codes.items():
+            send_verification_email(profile.user.email, code)
+        self.message_user(
+            request, f"Sent new verification codes to {len(codes)} profiles."
+        )
+
+    reset_verification_codes.short_description = "Reset verification codes"
+
     def get_readonly_fields(self, request, obj=None):
         readonly = list(self.readonly_fields)
         if obj and obj.is_email_verified:
             readonly.extend(
                 [
-                    "verification_code",
+                    "verification_code_hash",
                     "verification_expires_at",
                     "verification_attempts",
                 ]
@@ -138,6 +191,7 @@ class SubscriptionAdmin(ReadOnlyAdminDateFieldsMIXIN):
         "expires_at",
         "days_remaining_display",
     )
+    list_select_related = ("profile__user", "plan")
     list_filter = ("status", "is_active", "plan__plan_type", "created_at")
     search_fields = (
         "profile__user__email",
@@ -145,6 +199,7 @@ class SubscriptionAdmin(ReadOnlyAdminDateFieldsMIXIN):
         "payment_reference",
     )
     raw_id_fields = ("profile",)
+    actions = ["expire_subscriptions"]
 
     fieldsets = (
         (
@@ -164,12 +219,36 @@ class SubscriptionAdmin(ReadOnlyAdminDateFieldsMIXIN):
     def days_remaining_display(self, obj):
         days = obj.days_remaining()
         if days > 0:
-            return format_html('<span style="color: green;">{} days</span>', days)
+            return mark_safe(DAYS_REMAINING_HTML % days)
         else:
-            return format_html('<span style="color: red;">Expired</span>')
+            return EXPIRED_SUBSCRIPTION_HTML
 
     days_remaining_display.short_description = "Days Remaining"
 
+    # Edits made here bypass activate() and cancel(), which keep the premium
+    # flags of the profile in sync, so recompute them after every change
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        profile_ids = {obj.profile_id}
+        if change and "profile" in form.changed_data:
+            profile_ids.add(form.initial["profile"])
+        models.Profile.objects.filter(pk__in=profile_ids).refresh_premium_status()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        models.Profile.objects.filter(pk=obj.profile_id).refresh_premium_status()
+
+    def delete_queryset(self, request, queryset):
+        profile_ids = set(queryset.values_list("profile_id", flat=True))
+        super().delete_queryset(request, queryset)
+        models.Profile.objects.filter(pk__in=profile_ids).refresh_premium_status()
+
+    def expire_subscriptions(self, request, queryset):
+        expired = queryset.expire()
+        self.message_user(request, f"Expired {expired} subscriptions.")
+
+    expire_subscriptions.short_description = "Expire selected subscriptions"
+
 
 @admin.register(models.PaymentInvoice)
 class PaymentInvoiceAdmin(ReadOnlyAdminDateFieldsMIXIN):
@@ -185,6 +264,7 @@ class PaymentInvoiceAdmin(ReadOnlyAdminDateFieldsMIXIN):
         "is_paid",
         "created_at",
     )
+    list_select_related = ("profile__user", "subscription__plan")
     list_filter = ("status", "price_currency", "created_at")
     search_fields = (
         "order_id",
@@ -255,22 +335,20 @@ class PaymentInvoiceAdmin(ReadOnlyAdminDateFieldsMIXIN):
 
     def payment_url_display(self, obj):
         if obj.payment_url:
-            return format_html(
-                '<a href="{}" target="_blank">Payment Link</a>', obj.payment_url
-            )
+            return mark_safe(PAYMENT_LINK_HTML % escape(obj.payment_url))
         return "-"
 
     payment_url_display.short_description = "Payment URL"
 
     def is_paid(self, obj):
         if obj.is_paid():
-            return format_html('<span style="color: green;">✓ Paid</span>')
+            return PAID_HTML
         elif obj.is_expired():
-            return format_html('<span style="color: red;">✗ Expired</span>')
+            return EXPIRED_INVOICE_HTML
         elif obj.can_be_paid():
-            return format_html('<span style="color: orange;">⏳ Pending</span>')
+            return PENDING_HTML
         else:
-            return format_html('<span style="color: gray;">- N/A</span>')
+            return NOT_APPLICABLE_HTML
 
     is_paid.short_description = "Payment Status"
 
@@ -282,60 +360,69 @@ class PaymentInvoiceAdmin(ReadOnlyAdminDateFieldsMIXIN):
         updated_count = 0
         subscriptions_activated = 0
         error_count = 0
+        # Invoices that only need a status change, keyed by (old, new) status,
+        # are written with one UPDATE per bucket instead of a save() per row
+        status_buckets = defaultdict(list)
+        payment_service = get_payment_service()
+
+        invoices = queryset.select_related("subscription__profile").iterator(
+            chunk_size=CHECK_STATUS_CHUNK_SIZE
+        )
+        for index, invoice in enumerate(invoices, start=1):
+            if index % CHECK_STATUS_CHUNK_SIZE == 0:
+                updated, failed = self.flush_status_buckets(status_buckets)
+                updated_count += updated
+                error_count += failed
 
-        for invoice in queryset:
             try:
                 # Get status from payment service
                 status_data = payment_service.get_invoice_status(invoice.order_id)
-                logger.info(
-                    f"Status data for invoice {invoice.order_id}: {status_data}"
+                logger.debug(
+                    "Status data for invoice %s: %s", invoice.order_id, status_data
                 )
 
-                if status_data:
-                    # Update invoice with fresh data from payment service
-                    old_status = invoice.status
-                    new_status = status_data.get("status", invoice.status)
-                    invoice.status = new_status
-
-                    # Update metadata with sync information
-                    invoice.metadata.update(
-                        {
-                            "last_sync_at": timezone.now().isoformat(),
-                            "sync_source": "admin_action",
-                            "previous_status": old_status,
-                        }
+                if not status_data:
+                    error_count += 1
+                    continue
+
+                old_status = invoice.status
+                new_status = status_data.get("status", invoice.status)
+                if new_status != "finished":
+                    status_buckets[(old_status, new_status)].append(invoice.pk)
+                    continue
+
+                with transaction.atomic():
+                    # Payment is finished, mark the invoice as paid and merge the
+                    # sync information into metadata on the database side
+                    now = timezone.now()
+                    models.PaymentInvoice.objects.filter(pk=invoice.pk).update(
+                        status=new_status,
+                        paid_at=invoice.paid_at or now,
+                        updated_at=now,
+                        metadata=sync_metadata(old_status, now),
                     )
 
-                    # If payment is finished, ensure invoice is marked as paid and subscription is activated
-                    if new_status == "finished":
-                        # Mark as paid if not already marked
-                        if not invoice.paid_at:
-                            invoice.paid_at = timezone.now()
-
-                        # Always check and activate subscription if it's still pending
-                        # (This handles cases where payment was completed but subscription activation failed)
-                        if (
-                            invoice.subscription
-                            and invoice.subscription.status == "pending"
-                        ):
-                            invoice.subscription.activate()
-                            subscriptions_activated += 1
-
-                            # Update subscription payment reference
-                            invoice.subscription.payment_reference = (
-                                invoice.purchase_id or invoice.invoice_id
-                            )
-                            invoice.subscription.save()
-
-                    invoice.save()
-                    updated_count += 1
-                else:
-                    error_count += 1
+                    # Always check and activate subscription if it's still pending
+                    # (This handles cases where payment was completed but subscription activation failed)
+                    subscription = invoice.subscription
+                    if subscription and subscription.status == "pending":
+                        subscription.activate(
+                            payment_reference=invoice.purchase_id or invoice.invoice_id
+                        )
+                        subscriptions_activated += 1
+
+                updated_count += 1
 
-            except Exception as e:
+            except Exception:
                 error_count += 1
                 # Log the error but continue with other invoices
-                print(f"Error checking status for invoice {invoice.order_id}: {str(e)}")
+                logger.exception(
+                    "Error checking status for invoice %s", invoice.order_id
+                )
+
+        updated, failed = self.flush_status_buckets(status_buckets)
+        updated_count += updated
+        error_count += failed
 
         # Show results to admin
         message_parts = []
@@ -360,6 +447,32 @@ class PaymentInvoiceAdmin(ReadOnlyAdminDateFieldsMIXIN):
                 messages.WARNING,
             )
 
+    @staticmethod
+    def flush_status_buckets(status_buckets):
+        """Write the bucketed status-only changes and empty the buckets.
+
+        Returns:
+            tuple: number of updated and failed invoices
+        """
+        updated_count = 0
+        error_count = 0
+        now = timezone.now()
+        for (old_status, new_status), invoice_ids in status_buckets.items():
+            try:
+                models.PaymentInvoice.objects.filter(pk__in=invoice_ids).update(
+                    status=new_status,
+                    updated_at=now,
+                    metadata=sync_metadata(old_status, now),
+                )
+                updated_count += len(invoice_ids)
+            except Exception:
+                error_count += len(invoice_ids)
+                logger.exception(
+                    "Error updating invoices %s to status %s", invoice_ids, new_status
+                )
+        status_buckets.clear()
+        return updated_count, error_count
+
     check_payment_status.short_description = (
         "Check payment status and activate subscriptions"
     )
@@ -374,6 +487,7 @@ class FeatureUsageAdmin(ReadOnlyAdminDateFieldsMIXIN):
         "usage_count",
         "last_used",
     )
+    list_select_related = ("profile__user",)
     list_filter = ("feature_type", "last_used")
     search_fields = ("profile__user__email", "profile__cell_number")
     raw_id_fields = ("profile",)
@@ -1,9 +1,15 @@
-from functools import wraps
+from functools import cache, wraps
 
+from django.apps import apps
 from rest_framework import status
 from rest_framework.response import Response
 
 
+@cache
+def _feature_usage_model():
+    return apps.get_model("user", "FeatureUsage")
+
+
 def premium_required(feature_type=None):
     """
     Decorator to require premium subscription for accessing certain features.
@@ -23,7 +29,13 @@ def premium_required(feature_type=None):
 
             profile = request.user.profile
 
-            if not profile.has_active_premium_subscription():
+            # Nested premium-gated calls within one request share the result
+            premium_ok = getattr(request, "_premium_ok", None)
+            if premium_ok is None:
+                premium_ok = profile.has_active_premium_subscription()
+                request._premium_ok = premium_ok
+
+            if not premium_ok:
                 return Response(
                     {
                         "error": "Premium subscription required",
@@ -35,9 +47,7 @@ def premium_required(feature_type=None):
 
             # Track feature usage if feature_type is provided
             if feature_type:
-                from .models import FeatureUsage
-
-                usage, created = FeatureUsage.objects.get_or_create(
+                usage, created = _feature_usage_model().objects.get_or_create(
                     profile=profile,
                     feature_type=feature_type,
                     defaults={"usage_count": 0},
@@ -76,9 +86,7 @@ def track_feature_usage(profile, feature_type, metadata=None):
         feature_type: Type of feature being used
         metadata: Optional metadata dictionary
     """
-    from .models import FeatureUsage
-
-    usage, created = FeatureUsage.objects.get_or_create(
+    usage, created = _feature_usage_model().objects.get_or_create(
         profile=profile, feature_type=feature_type, defaults={"usage_count": 0}
     )
     usage.increment_usage(metadata)
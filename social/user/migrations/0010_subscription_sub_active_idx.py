@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-16 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0009_alter_paymentinvoice_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['profile', 'expires_at'], name='sub_active_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-16 09:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0010_subscription_sub_active_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(condition=models.Q(('is_email_verified', False)), fields=['verification_code'], name='profile_vcode_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-16 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0011_profile_profile_vcode_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['profile', 'is_active', 'expires_at'], name='sub_profile_active_exp_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-16 10:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0012_subscription_sub_profile_active_exp_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='paymentinvoice',
+            index=models.Index(fields=['profile', 'status'], name='invoice_profile_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paymentinvoice',
+            index=models.Index(fields=['status', 'expires_at'], name='invoice_status_exp_idx'),
+        ),
+    ]
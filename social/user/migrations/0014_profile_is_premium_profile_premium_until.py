@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-16 10:41
+
+from django.db import migrations, models
+from django.db.models.functions import Now
+
+
+def fill_premium_flags(apps, schema_editor):
+    Profile = apps.get_model("user", "Profile")
+    Subscription = apps.get_model("user", "Subscription")
+    active_subscriptions = Subscription.objects.filter(
+        is_active=True, status="active", expires_at__gt=Now()
+    ).order_by("profile_id", "-expires_at")
+    for subscription in active_subscriptions.distinct("profile_id"):
+        Profile.objects.filter(pk=subscription.profile_id).update(
+            is_premium=True, premium_until=subscription.expires_at
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0013_paymentinvoice_invoice_profile_status_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='is_premium',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='premium_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_premium_flags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2 on 2026-10-16 11:05
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_verification_codes(apps, schema_editor):
+    Profile = apps.get_model("user", "Profile")
+    profiles = Profile.objects.exclude(verification_code_hash__isnull=True).exclude(
+        verification_code_hash=""
+    )
+    for profile in profiles.only("id", "verification_code_hash").iterator():
+        code = profile.verification_code_hash
+        Profile.objects.filter(pk=profile.pk).update(
+            verification_code_hash=hashlib.sha256(code.encode()).hexdigest()[:32]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0014_profile_is_premium_profile_premium_until'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='profile',
+            name='profile_vcode_idx',
+        ),
+        migrations.RenameField(
+            model_name='profile',
+            old_name='verification_code',
+            new_name='verification_code_hash',
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='verification_code_hash',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.RunPython(hash_verification_codes, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(condition=models.Q(('is_email_verified', False)), fields=['verification_code_hash'], name='profile_vcode_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-16 12:20
+
+from django.db import migrations
+
+
+def create_missing_profiles(apps, schema_editor):
+    User = apps.get_model("auth", "User")
+    Profile = apps.get_model("user", "Profile")
+    Profile.objects.bulk_create(
+        [
+            Profile(user_id=user_id)
+            for user_id in User.objects.filter(profile__isnull=True).values_list(
+                "id", flat=True
+            )
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0015_profile_verification_code_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_missing_profiles, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2 on 2026-10-16 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0016_create_missing_profiles'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['profile', '-created_at'], name='sub_profile_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paymentinvoice',
+            index=models.Index(fields=['profile', '-created_at'], name='invoice_profile_created_idx'),
+        ),
+    ]
@@ -1,10 +1,85 @@
+import hashlib
+import hmac
 import secrets
 from datetime import timedelta
-
-from django.db import models
+from functools import cache
+
+from django.apps import apps
+from django.core.cache import cache as django_cache
+from django.db import IntegrityError, models, transaction
+from django.db.models import (Case, ExpressionWrapper, F, Q, Value,
+                              When)
+from django.db.models.functions import ExtractDay, Now
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 
-from reusable.models import BaseModel
+from reusable.models import BaseModel, JSONBMerge
+from reusable.time import request_now
+
+PREMIUM_STATUS_CACHE_TIMEOUT = 5 * 60
+PLAN_CACHE_TIMEOUT = 60 * 60
+PLAN_CACHE_VERSION_KEY = "plan_cache_version"
+# Invoice statuses that still wait for (more) payment
+PENDING_PAYMENT_STATUSES = ["waiting", "confirming", "confirmed", "partially_paid"]
+
+# Shared OS-backed generator for verification codes
+_rng = secrets.SystemRandom()
+
+
+def premium_status_cache_key(profile_id):
+    return f"prof:{profile_id}:premium_status"
+
+
+def subscription_cache_keys(profile_id):
+    """Every cached value derived from the subscriptions of a profile."""
+    return [premium_status_cache_key(profile_id)]
+
+
+@cache
+def get_linkedin_model(class_name):
+    # linkedin.models imports Profile, so it can't be imported at module level
+    return apps.get_model("linkedin", class_name)
+
+
+class ProfileQuerySet(models.QuerySet):
+    def with_user(self):
+        """Join auth.User, which ProfileSerializer always renders."""
+        return self.select_related("user")
+
+    def without_text(self):
+        """Skip the free-text columns, which can be several KB per row."""
+        return self.defer(*self.model.TEXT_FIELDS)
+
+    def reset_verification_codes(self, batch_size=1000):
+        """
+        Give every unverified profile a fresh code using bulk UPDATEs.
+        Only hashes are stored, so the plain codes are returned keyed by profile.
+        """
+        codes = {}
+        profiles = self.filter(is_email_verified=False).select_related("user")
+        for profile in profiles.only(*self.model.VERIFICATION_FIELDS, "user__email"):
+            codes[profile] = profile.set_verification_code()
+        self.model.objects.bulk_update(
+            codes,
+            [
+                "verification_code_hash",
+                "verification_expires_at",
+                "verification_attempts",
+            ],
+            batch_size=batch_size,
+        )
+        return codes
+
+    def refresh_premium_status(self):
+        """Recompute the premium flags of these profiles from their subscriptions."""
+        profile_ids = []
+        for profile in self.only("id"):
+            profile.refresh_premium_status()
+            profile_ids.append(profile.pk)
+        django_cache.delete_many(
+            [key for pk in profile_ids for key in subscription_cache_keys(pk)]
+        )
 
 
 class Profile(BaseModel):
@@ -18,29 +93,106 @@ class Profile(BaseModel):
     professional_experience = models.TextField(null=True, blank=True)
 
     # Email verification fields
-    verification_code = models.CharField(max_length=6, null=True, blank=True)
+    # Only a truncated SHA-256 of the code is stored, see set_verification_code()
+    verification_code_hash = models.CharField(max_length=32, null=True, blank=True)
     verification_expires_at = models.DateTimeField(null=True, blank=True)
     verification_attempts = models.IntegerField(default=0)
     is_email_verified = models.BooleanField(default=False)
 
+    # Denormalized from the active subscription, kept by Subscription.activate()
+    # and cancel() and swept by the expire_premium_flags task
+    is_premium = models.BooleanField(default=False)
+    premium_until = models.DateTimeField(null=True, blank=True)
+
+    objects = ProfileQuerySet.as_manager()
+
+    # Free-text columns that listings and lookups rarely need
+    TEXT_FIELDS = (
+        "about_me",
+        "additional_notes",
+        "education_background",
+        "professional_experience",
+    )
+    # Columns needed to check a verification code, handy with QuerySet.only()
+    VERIFICATION_FIELDS = (
+        "id",
+        "verification_code_hash",
+        "verification_expires_at",
+        "verification_attempts",
+        "is_email_verified",
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["verification_code_hash"],
+                condition=Q(is_email_verified=False),
+                name="profile_vcode_idx",
+            ),
+        ]
+
     def __str__(self):
         return f"({self.pk} - {self.cell_number or self.user.email})"
 
     def save(self, *args, **kwargs):
-        if not self.verification_code and not self.is_email_verified:
-            self.verification_code = self.generate_verification_code()
-        if not self.verification_expires_at and not self.is_email_verified:
-            self.verification_expires_at = timezone.now() + timedelta(minutes=10)
+        # Narrow saves (update_fields) never write the verification fields, so
+        # there is no point in generating them here
+        if kwargs.get("update_fields") is None and not self.is_email_verified:
+            if not self.verification_code_hash:
+                # Also sets verification_expires_at
+                self.set_verification_code()
+            elif not self.verification_expires_at:
+                self.verification_expires_at = timezone.now() + timedelta(minutes=10)
         super().save(*args, **kwargs)
 
     @staticmethod
     def generate_verification_code():
-        return str(secrets.randbelow(900000) + 100000)
+        return f"{_rng.randrange(100000, 1000000)}"
+
+    @staticmethod
+    def hash_verification_code(code):
+        return hashlib.sha256(str(code).encode()).hexdigest()[:32]
+
+    def set_verification_code(self):
+        """Generate a new code, keep only its hash and return the plain code."""
+        code = self.generate_verification_code()
+        self.verification_code_hash = self.hash_verification_code(code)
+        self.verification_expires_at = timezone.now() + timedelta(minutes=10)
+        self.verification_attempts = 0
+        return code
+
+    @classmethod
+    def issue_verification_code(cls, user_id):
+        """
+        Give the user's profile a fresh code, creating the profile if needed,
+        with a single INSERT ... ON CONFLICT. Returns the plain code.
+        """
+        profile = cls(user_id=user_id)
+        code = profile.set_verification_code()
+        cls.objects.bulk_create(
+            [profile],
+            update_conflicts=True,
+            unique_fields=["user"],
+            update_fields=[
+                "verification_code_hash",
+                "verification_expires_at",
+                "verification_attempts",
+                "updated_at",
+            ],
+        )
+        return code
+
+    def check_verification_code(self, code):
+        if not self.verification_code_hash:
+            return False
+        return hmac.compare_digest(
+            self.verification_code_hash, self.hash_verification_code(code)
+        )
 
     def is_verification_expired(self):
         if not self.verification_expires_at:
             return True
-        return timezone.now() > self.verification_expires_at
+        return request_now() > self.verification_expires_at
 
     def can_attempt_verification(self):
         max_attempts = 3
@@ -50,91 +202,105 @@ class Profile(BaseModel):
         )
 
     def increment_verification_attempts(self):
+        # Increment in the database so concurrent attempts are all counted
+        Profile.objects.filter(pk=self.pk).update(
+            verification_attempts=F("verification_attempts") + 1
+        )
         self.verification_attempts += 1
-        self.save(update_fields=["verification_attempts"])
 
     def mark_email_as_verified(self):
         self.is_email_verified = True
-        self.verification_code = None
+        self.verification_code_hash = None
         self.verification_expires_at = None
         self.verification_attempts = 0
         self.save(
             update_fields=[
                 "is_email_verified",
-                "verification_code",
+                "verification_code_hash",
                 "verification_expires_at",
                 "verification_attempts",
             ]
         )
 
     def reset_verification_code(self):
-        self.verification_code = self.generate_verification_code()
-        self.verification_expires_at = timezone.now() + timedelta(minutes=10)
-        self.verification_attempts = 0
+        code = self.set_verification_code()
         self.save(
             update_fields=[
-                "verification_code",
+                "verification_code_hash",
                 "verification_expires_at",
                 "verification_attempts",
             ]
         )
+        return code
 
     def add_favorite_job(self, job):
         """Add a job to user's favorites."""
-        from linkedin.models import FavoriteJob
-
-        favorite, created = FavoriteJob.objects.get_or_create(profile=self, job=job)
-        return favorite, created
+        favorite_job_model = get_linkedin_model("FavoriteJob")
+        # Insert first and rely on the (profile, job) unique constraint, so a
+        # new favorite is a single INSERT instead of a SELECT followed by one
+        try:
+            with transaction.atomic():
+                return favorite_job_model.objects.create(profile=self, job=job), True
+        except IntegrityError:
+            return favorite_job_model.objects.get(profile=self, job=job), False
 
     def remove_favorite_job(self, job):
         """Remove a job from user's favorites."""
-        from linkedin.models import FavoriteJob
-
-        try:
-            favorite = FavoriteJob.objects.get(profile=self, job=job)
-            favorite.delete()
-            return True
-        except FavoriteJob.DoesNotExist:
-            return False
+        favorite_job_model = get_linkedin_model("FavoriteJob")
+        deleted, _ = favorite_job_model.objects.filter(profile=self, job=job).delete()
+        return bool(deleted)
 
     def is_job_favorite(self, job):
         """Check if a job is in user's favorites."""
-        from linkedin.models import FavoriteJob
-
-        return FavoriteJob.objects.filter(profile=self, job=job).exists()
+        favorite_job_model = get_linkedin_model("FavoriteJob")
+        return favorite_job_model.objects.filter(profile=self, job=job).exists()
 
     def get_favorite_jobs(self):
         """Get all favorite jobs for this user."""
-        from linkedin.models import Job
-
-        return Job.objects.filter(favorited_by__profile=self).order_by("-created_at")
+        job_model = get_linkedin_model("Job")
+        return (
+            job_model.objects.filter(favorited_by__profile=self)
+            .prefetch_related("matched_keywords")
+            .order_by("-created_at")
+        )
 
     def has_active_premium_subscription(self):
         """Check if user has an active premium subscription."""
-        return Subscription.objects.filter(
-            profile=self, is_active=True, status="active", expires_at__gt=timezone.now()
-        ).exists()
+        return self.is_premium and (
+            self.premium_until is None or self.premium_until > request_now()
+        )
+
+    def refresh_premium_status(self):
+        """Recompute the premium flags from the remaining active subscription."""
+        subscription = (
+            Subscription.objects.active()
+            .filter(profile=self, status="active")
+            .order_by("-expires_at")
+            .first()
+        )
+        self.is_premium = subscription is not None
+        self.premium_until = subscription.expires_at if subscription else None
+        self.save(update_fields=["is_premium", "premium_until"])
 
     def get_active_subscription(self):
         """Get the user's active subscription if any."""
-        try:
-            return Subscription.objects.get(
-                profile=self,
-                is_active=True,
-                status="active",
-                expires_at__gt=timezone.now(),
-            )
-        except Subscription.DoesNotExist:
-            return None
+        return (
+            Subscription.objects.active()
+            .filter(profile=self, status="active")
+            .order_by("-expires_at")
+            .first()
+        )
 
     def get_latest_subscription(self):
         """Get the user's latest subscription regardless of status."""
-        try:
-            return Subscription.objects.filter(
-                profile=self, is_active=True, expires_at__gt=timezone.now()
-            ).first()
-        except Subscription.DoesNotExist:
-            return None
+        # Joined with its plan and expiry computed, ready for SubscriptionSerializer
+        return (
+            Subscription.objects.active()
+            .filter(profile=self)
+            .select_related("plan")
+            .with_expiry()
+            .first()
+        )
 
 
 class SubscriptionPlan(BaseModel):
@@ -159,6 +325,70 @@ class SubscriptionPlan(BaseModel):
     def __str__(self):
         return f"{self.name} - {self.get_plan_type_display()}"
 
+    @staticmethod
+    def cache_version():
+        """Version of the cached plans; changes whenever any plan changes."""
+        return django_cache.get_or_set(
+            PLAN_CACHE_VERSION_KEY, lambda: secrets.token_hex(4), None
+        )
+
+    @classmethod
+    def get_cached(cls, plan_id):
+        """Get an active plan by id from the cache, or None if there is none."""
+        return django_cache.get_or_set(
+            f"plan:{plan_id}",
+            lambda: cls.objects.filter(id=plan_id, is_active=True).first(),
+            PLAN_CACHE_TIMEOUT,
+            version=cls.cache_version(),
+        )
+
+
+def is_expired_expression():
+    """SQL counterpart of the is_expired() model methods."""
+    return Case(
+        When(expires_at__lt=Now(), then=Value(True)),
+        default=Value(False),
+        output_field=models.BooleanField(),
+    )
+
+
+class SubscriptionQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(is_active=True, expires_at__gt=Now())
+
+    def expire(self):
+        """Mark subscriptions as expired with one UPDATE, returns the row count."""
+        # Cancelled and pending rows keep their status for reporting
+        running = self.filter(is_active=True, status="active")
+        # update() skips the post_save receivers, so clear what they maintain
+        profile_ids = list(running.values_list("profile_id", flat=True))
+        expired = running.update(
+            is_active=False, status="expired", updated_at=timezone.now()
+        )
+        if profile_ids:
+            Profile.objects.filter(pk__in=profile_ids).update(
+                is_premium=False, premium_until=None
+            )
+            django_cache.delete_many(
+                [key for pk in profile_ids for key in subscription_cache_keys(pk)]
+            )
+        return expired
+
+    def with_expiry(self):
+        """Annotate annotated_is_expired and annotated_days_remaining."""
+        return self.annotate(
+            annotated_is_expired=is_expired_expression(),
+            annotated_days_remaining=Case(
+                When(expires_at__lt=Now(), then=Value(0)),
+                default=ExtractDay(
+                    ExpressionWrapper(
+                        F("expires_at") - Now(), output_field=models.DurationField()
+                    )
+                ),
+                output_field=models.IntegerField(),
+            ),
+        )
+
 
 class Subscription(BaseModel):
     """User subscription model."""
@@ -181,8 +411,24 @@ class Subscription(BaseModel):
     payment_reference = models.CharField(max_length=255, blank=True, null=True)
     auto_renew = models.BooleanField(default=True)
 
+    objects = SubscriptionQuerySet.as_manager()
+
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(
+                fields=["profile", "expires_at"],
+                condition=Q(is_active=True),
+                name="sub_active_idx",
+            ),
+            models.Index(
+                fields=["profile", "is_active", "expires_at"],
+                name="sub_profile_active_exp_idx",
+            ),
+            models.Index(
+                fields=["profile", "-created_at"], name="sub_profile_created_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.profile} - {self.plan} ({self.status})"
@@ -194,37 +440,68 @@ class Subscription(BaseModel):
 
     def is_expired(self):
         """Check if subscription is expired."""
-        return timezone.now() > self.expires_at
+        return request_now() > self.expires_at
 
     def days_remaining(self):
         """Get days remaining in subscription."""
         if self.is_expired():
             return 0
-        return (self.expires_at - timezone.now()).days
+        return (self.expires_at - request_now()).days
 
-    def activate(self):
-        """Activate the subscription."""
+    def activate(self, payment_reference=None):
+        """Activate the subscription, optionally recording its payment reference."""
         # Deactivate any existing active subscriptions for this profile
-        Subscription.objects.filter(profile=self.profile, is_active=True).update(
-            is_active=False, status="cancelled"
-        )
+        Subscription.objects.filter(profile_id=self.profile_id, is_active=True).exclude(
+            pk=self.pk
+        ).update(is_active=False, status="cancelled")
 
         self.is_active = True
         self.status = "active"
-        self.save()
+        update_fields = ["is_active", "status", "updated_at"]
+        if payment_reference:
+            self.payment_reference = payment_reference
+            update_fields.append("payment_reference")
+        self.save(update_fields=update_fields)
+
+        profile = self.profile
+        profile.is_premium = True
+        profile.premium_until = self.expires_at
+        profile.save(update_fields=["is_premium", "premium_until"])
 
     def cancel(self):
-        """Cancel the subscription and associated payment invoices."""
+        """
+        Cancel the subscription and associated payment invoices.
+        Returns the number of payment invoices that were cancelled.
+        """
         self.is_active = False
         self.status = "cancelled"
-        self.save()
+        self.save(update_fields=["is_active", "status", "updated_at"])
+        self.profile.refresh_premium_status()
 
-        # Cancel any pending payment invoices for this subscription
+        # Cancel any pending payment invoices for this subscription. This is
+        # all PaymentInvoice.cancel() would do here, since the subscription it
+        # would cascade to is this one and no longer pending.
         pending_invoices = self.payment_invoices.filter(
-            status__in=["waiting", "confirming", "confirmed", "partially_paid"]
+            status__in=PENDING_PAYMENT_STATUSES
+        )
+        return pending_invoices.update(status="cancelled", updated_at=timezone.now())
+
+
+class PaymentInvoiceQuerySet(models.QuerySet):
+    def with_expiry(self):
+        """Annotate annotated_is_expired and annotated_can_be_paid."""
+        return self.annotate(
+            annotated_is_expired=is_expired_expression(),
+            annotated_can_be_paid=Case(
+                When(
+                    Q(expires_at__isnull=True) | Q(expires_at__gt=Now()),
+                    status__in=PENDING_PAYMENT_STATUSES,
+                    then=Value(True),
+                ),
+                default=Value(False),
+                output_field=models.BooleanField(),
+            ),
         )
-        for invoice in pending_invoices:
-            invoice.cancel()
 
 
 class PaymentInvoice(BaseModel):
@@ -284,8 +561,21 @@ class PaymentInvoice(BaseModel):
     order_description = models.TextField()
     metadata = models.JSONField(default=dict, blank=True)
 
+    objects = PaymentInvoiceQuerySet.as_manager()
+
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(
+                fields=["profile", "status"], name="invoice_profile_status_idx"
+            ),
+            models.Index(
+                fields=["status", "expires_at"], name="invoice_status_exp_idx"
+            ),
+            models.Index(
+                fields=["profile", "-created_at"], name="invoice_profile_created_idx"
+            ),
+        ]
 
     def __str__(self):
         return f"Invoice {self.order_id} - {self.status} (${self.price_amount})"
@@ -298,24 +588,21 @@ class PaymentInvoice(BaseModel):
         """Check if invoice is expired."""
         if not self.expires_at:
             return False
-        return timezone.now() > self.expires_at
+        return request_now() > self.expires_at
 
     def can_be_paid(self):
         """Check if invoice can still be paid."""
-        return (
-            self.status in ["waiting", "confirming", "confirmed", "partially_paid"]
-            and not self.is_expired()
-        )
+        return self.status in PENDING_PAYMENT_STATUSES and not self.is_expired()
 
     def can_be_cancelled(self):
         """Check if invoice can be cancelled."""
-        return self.status in ["waiting", "confirming", "confirmed", "partially_paid"]
+        return self.status in PENDING_PAYMENT_STATUSES
 
     def cancel(self):
         """Cancel the payment invoice and associated subscription if applicable."""
         if self.can_be_cancelled():
             self.status = "cancelled"
-            self.save()
+            self.save(update_fields=["status", "updated_at"])
 
             # Cancel associated subscription if it exists and is still pending
             if self.subscription and self.subscription.status == "pending":
@@ -350,7 +637,40 @@ class FeatureUsage(BaseModel):
 
     def increment_usage(self, metadata=None):
         """Increment usage count for this feature."""
-        self.usage_count += 1
+        now = timezone.now()
+        updates = {
+            "usage_count": F("usage_count") + 1,
+            "last_used": now,
+            "updated_at": now,
+        }
         if metadata:
+            updates["metadata"] = JSONBMerge("metadata", metadata)
             self.metadata.update(metadata)
-        self.save()
+        FeatureUsage.objects.filter(pk=self.pk).update(**updates)
+
+        self.usage_count += 1
+        self.last_used = now
+        self.updated_at = now
+
+
+@receiver(post_save, sender="auth.User")
+def user_created(sender, instance, created, raw=False, **kwargs):
+    """Every user gets a profile, so views can rely on user.profile."""
+    if created and not raw:
+        # bulk_create() skips Profile.save(), which would generate and hash a
+        # code that issue_verification_code() overwrites right away
+        Profile.objects.bulk_create([Profile(user=instance)], ignore_conflicts=True)
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def subscription_changed(sender, instance, **kwargs):
+    """Invalidate the cached subscription data of the profile."""
+    django_cache.delete_many(subscription_cache_keys(instance.profile_id))
+
+
+@receiver(post_save, sender=SubscriptionPlan)
+@receiver(post_delete, sender=SubscriptionPlan)
+def subscription_plan_changed(sender, **kwargs):
+    """Invalidate all cached plans by moving to a new cache version."""
+    django_cache.set(PLAN_CACHE_VERSION_KEY, secrets.token_hex(4), None)
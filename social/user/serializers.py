@@ -1,5 +1,4 @@
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import User
 from rest_framework import serializers
 
 from .models import (FeatureUsage, PaymentInvoice, Profile, Subscription,
@@ -7,12 +6,15 @@ from .models import (FeatureUsage, PaymentInvoice, Profile, Subscription,
 
 User = get_user_model()
 
+# Resolved once instead of through get_FOO_display() on every row
+FEATURE_TYPE_LABELS = dict(FeatureUsage.FEATURE_TYPES)
+
 
 class EmailVerificationRequestSerializer(serializers.Serializer):
     email = serializers.EmailField()
 
     def validate_email(self, value):
-        return value.lower()
+        return value.casefold()
 
 
 class EmailVerificationConfirmSerializer(serializers.Serializer):
@@ -20,7 +22,7 @@ class EmailVerificationConfirmSerializer(serializers.Serializer):
     code = serializers.CharField(max_length=6, min_length=6)
 
     def validate_email(self, value):
-        return value.lower()
+        return value.casefold()
 
     def validate_code(self, value):
         if not value.isdigit():
@@ -43,7 +45,7 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         }
 
     def validate_email(self, value):
-        return value.lower()
+        return value.casefold()
 
     def validate_verification_code(self, value):
         if not value.isdigit():
@@ -57,15 +59,15 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         code = attrs["verification_code"]
 
         # Check if user exists and get their profile
-        try:
-            user = User.objects.get(email=email)
-            profile = user.profile
-        except User.DoesNotExist:
+        profile = (
+            Profile.objects.with_user().without_text().filter(user__email=email).first()
+        )
+        if profile is None:
             raise serializers.ValidationError(
                 "User not found. Please request a verification code first."
             )
 
-        if not profile.verification_code or profile.verification_code != code:
+        if not profile.check_verification_code(code):
             raise serializers.ValidationError("Invalid verification code")
 
         if profile.is_verification_expired():
@@ -88,11 +90,13 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         user = profile.user
 
         # Update user information if provided
-        if "first_name" in validated_data:
-            user.first_name = validated_data["first_name"]
-        if "last_name" in validated_data:
-            user.last_name = validated_data["last_name"]
-        user.save()
+        update_fields = []
+        for field in ("first_name", "last_name"):
+            if field in validated_data:
+                setattr(user, field, validated_data[field])
+                update_fields.append(field)
+        if update_fields:
+            user.save(update_fields=update_fields)
 
         return user
 
@@ -170,16 +174,18 @@ class SubscriptionSerializer(serializers.ModelSerializer):
         read_only_fields = ["id", "profile", "created_at", "updated_at", "expires_at"]
 
     def get_days_remaining(self, obj):
-        return obj.days_remaining()
+        annotated = getattr(obj, "annotated_days_remaining", None)
+        return obj.days_remaining() if annotated is None else annotated
 
     def get_is_expired(self, obj):
-        return obj.is_expired()
+        # Querysets built with with_expiry() already computed it in SQL
+        annotated = getattr(obj, "annotated_is_expired", None)
+        return obj.is_expired() if annotated is None else annotated
 
     def create(self, validated_data):
         plan_id = validated_data.pop("plan_id")
-        try:
-            plan = SubscriptionPlan.objects.get(id=plan_id, is_active=True)
-        except SubscriptionPlan.DoesNotExist:
+        plan = SubscriptionPlan.get_cached(plan_id)
+        if plan is None:
             raise serializers.ValidationError("Invalid subscription plan.")
 
         validated_data["plan"] = plan
@@ -245,18 +251,19 @@ class PaymentInvoiceSerializer(serializers.ModelSerializer):
         return obj.is_paid()
 
     def get_is_expired(self, obj):
-        return obj.is_expired()
+        # Querysets built with with_expiry() already computed it in SQL
+        annotated = getattr(obj, "annotated_is_expired", None)
+        return obj.is_expired() if annotated is None else annotated
 
     def get_can_be_paid(self, obj):
-        return obj.can_be_paid()
+        annotated = getattr(obj, "annotated_can_be_paid", None)
+        return obj.can_be_paid() if annotated is None else annotated
 
 
 class FeatureUsageSerializer(serializers.ModelSerializer):
     """Serializer for feature usage tracking."""
 
-    feature_type_display = serializers.CharField(
-        source="get_feature_type_display", read_only=True
-    )
+    feature_type_display = serializers.SerializerMethodField()
 
     class Meta:
         model = FeatureUsage
@@ -269,3 +276,6 @@ class FeatureUsageSerializer(serializers.ModelSerializer):
             "metadata",
         ]
         read_only_fields = ["id", "profile", "last_used"]
+
+    def get_feature_type_display(self, obj):
+        return FEATURE_TYPE_LABELS.get(obj.feature_type, obj.feature_type)
@@ -1,57 +1,87 @@
 import logging
-import uuid
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import as_completed
 from datetime import datetime
 from decimal import Decimal
+from functools import cache
 from typing import Dict, Optional
 
+import orjson
 import requests
 from django.conf import settings
+from django.db import DatabaseError, transaction
 from django.utils import timezone as django_timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from reusable.models import JSONBMerge
 from .models import PaymentInvoice, Profile, Subscription
 
 logger = logging.getLogger(__name__)
 
+# Webhook fields kept in the invoice metadata; the rest of the payload is
+# dropped so repeated deliveries don't grow the column
+WEBHOOK_METADATA_KEYS = ("status", "pay_amount", "pay_currency", "actually_paid")
+
+
+class PaymentServiceError(Exception):
+    """The payment service could not be reached or rejected the request."""
+
 
 class CoinPaymentService:
     """Service class for interacting with NodeJS Coin Payment API."""
 
     def __init__(self):
-        self._base_url = "https://coin-payment.m-gh.com"
+        self._base_url = settings.COIN_PAYMENT_BASE_URL
         self._api_secret = settings.COIN_PAYMENT_API_SECRET
         self.timeout = 30
+        self._session = self._build_session()
+        self._hedge_executor = None
+        if settings.COIN_PAYMENT_HEDGE_ENABLED:
+            self._hedge_executor = ThreadPoolExecutor(
+                max_workers=4, thread_name_prefix="coin-payment-hedge"
+            )
+
+    def _build_session(self) -> requests.Session:
+        """Session shared by all calls so connections are kept alive and pooled."""
+        session = requests.Session()
+        session.headers["Content-Type"] = "application/json"
+        if self._api_secret:
+            session.headers["Authorization"] = f"Bearer {self._api_secret}"
+        # Retry only idempotent requests (urllib3 skips POST by default)
+        retries = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+        session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries),
+        )
+        return session
 
     def _make_request(
         self, method: str, endpoint: str, data: Optional[Dict] = None
     ) -> Dict:
         """Make HTTP request to payment service."""
         url = f"{self._base_url}{endpoint}"
-        headers = {
-            "Content-Type": "application/json",
-        }
-
-        if self._api_secret:
-            headers["Authorization"] = f"Bearer {self._api_secret}"
 
         try:
             if method.upper() == "GET":
-                response = requests.get(
-                    url, headers=headers, timeout=self.timeout, params=data
-                )
+                response = self._session.get(url, timeout=self.timeout, params=data)
             elif method.upper() == "POST":
-                response = requests.post(
-                    url, headers=headers, json=data, timeout=self.timeout
+                response = self._session.post(
+                    url, data=orjson.dumps(data), timeout=self.timeout
                 )
             else:
-                raise Exception(f"Unsupported HTTP method: {method}")
+                raise PaymentServiceError(f"Unsupported HTTP method: {method}")
 
             response.raise_for_status()
-            return response.json()
+            # orjson.JSONDecodeError is a ValueError, handled below
+            return orjson.loads(response.content)
 
         except requests.exceptions.RequestException as e:
-            raise Exception(f"Payment service request failed: {str(e)}")
+            raise PaymentServiceError(f"Payment service request failed: {str(e)}")
         except ValueError as e:
-            raise Exception(f"Invalid JSON response: {str(e)}")
+            raise PaymentServiceError(f"Invalid JSON response: {str(e)}")
 
     def create_invoice(
         self,
@@ -66,15 +96,17 @@ class CoinPaymentService:
         """Create a payment invoice for a subscription."""
 
         # Generate unique order ID
-        order_id = f"sub_{subscription.id}_{uuid.uuid4().hex[:8]}"
+        order_id = f"sub_{subscription.id}_{secrets.token_hex(4)}"
 
         # Prepare invoice data
+        plan = subscription.plan
+        email = profile.user.email
         invoice_data = {
             "priceAmount": float(price_amount),
             "priceCurrency": price_currency,
             "orderId": order_id,
-            "orderDescription": f"Subscription: {subscription.plan.name} ({subscription.plan.get_plan_type_display()})",
-            "customerEmail": profile.user.email,
+            "orderDescription": f"Subscription: {plan.name} ({plan.get_plan_type_display()})",
+            "customerEmail": email,
         }
 
         # Add redirect URLs if provided
@@ -91,7 +123,7 @@ class CoinPaymentService:
         )
 
         if not response_data.get("success"):
-            raise Exception(
+            raise PaymentServiceError(
                 f"Failed to create invoice: {response_data.get('message', 'Unknown error')}"
             )
 
@@ -101,9 +133,8 @@ class CoinPaymentService:
         expires_at = None
         if invoice_info.get("expiresAt"):
             try:
-                expires_at = datetime.fromisoformat(
-                    invoice_info["expiresAt"].replace("Z", "+00:00")
-                ).replace(tzinfo=django_timezone.utc)
+                # Python 3.11 parses the trailing "Z" natively
+                expires_at = datetime.fromisoformat(invoice_info["expiresAt"])
             except (ValueError, TypeError):
                 pass
 
@@ -120,29 +151,53 @@ class CoinPaymentService:
             pay_currency=invoice_info.get("payCurrency"),
             status=invoice_info.get("status", "waiting"),
             expires_at=expires_at,
-            customer_email=profile.user.email,
+            customer_email=email,
             order_description=invoice_data["orderDescription"],
             metadata={
-                "subscription_plan_id": subscription.plan.id,
-                "subscription_plan_name": subscription.plan.name,
+                "subscription_plan_id": plan.id,
+                "subscription_plan_name": plan.name,
                 "created_via_api": True,
             },
         )
 
         return payment_invoice
 
+    def _make_hedged_request(self, endpoint: str, data: Optional[Dict] = None) -> Dict:
+        """
+        GET that fires a duplicate request when the first one is slower than
+        COIN_PAYMENT_HEDGE_DELAY and returns whichever succeeds first.
+        Only meant for idempotent reads.
+        """
+        if self._hedge_executor is None:
+            return self._make_request("GET", endpoint, data)
+
+        first = self._hedge_executor.submit(self._make_request, "GET", endpoint, data)
+        try:
+            return first.result(timeout=settings.COIN_PAYMENT_HEDGE_DELAY)
+        except FuturesTimeoutError:
+            pass
+
+        second = self._hedge_executor.submit(self._make_request, "GET", endpoint, data)
+        error = None
+        for future in as_completed((first, second)):
+            try:
+                return future.result()
+            except PaymentServiceError as e:
+                error = e
+        raise error
+
     def get_invoice_status(self, order_id: str) -> Dict:
         """Get invoice status by order ID."""
-        response_data = self._make_request(
-            "GET", "/api/payment/invoices", {"orderId": order_id}
+        response_data = self._make_hedged_request(
+            "/api/payment/invoices", {"orderId": order_id}
         )
-        logger.info(f"Response data for get invoice status: {response_data}")
+        logger.debug("Response data for get invoice status: %s", response_data)
 
         return response_data
 
     def process_webhook_data(self, webhook_data: Dict) -> bool:
         """Process webhook data from payment service."""
-        logger.info(f"Processing webhook data: {webhook_data}")
+        logger.info("Processing webhook data: %s", webhook_data)
         try:
             order_id = webhook_data.get("order_id")
             if not order_id:
@@ -150,42 +205,59 @@ class CoinPaymentService:
 
             # Find the corresponding payment invoice
             try:
-                payment_invoice = PaymentInvoice.objects.get(order_id=order_id)
-            except Exception:
+                # Skip metadata and the other columns, they are written with
+                # update() below and never read here
+                payment_invoice = (
+                    PaymentInvoice.objects.select_related("subscription__profile")
+                    .only("id", "status", "invoice_id", "purchase_id", "subscription")
+                    .get(order_id=order_id)
+                )
+            except PaymentInvoice.DoesNotExist:
                 return False
 
             if payment_invoice.status in ["finished", "cancelled", "failed", "expired"]:
-                logger.info(f"Payment invoice {order_id} is already processed")
+                logger.info("Payment invoice %s is already processed", order_id)
                 return False
 
-            # Update metadata
-            payment_invoice.metadata.update(
-                {
-                    "webhook_received_at": django_timezone.now().isoformat(),
-                    "webhook_data": webhook_data,
-                }
-            )
-
-            # Activate the subscription
-            if payment_invoice.subscription:
-                payment_invoice.subscription.activate()
-
-                # Update subscription payment reference
-                payment_invoice.subscription.payment_reference = (
-                    payment_invoice.purchase_id or payment_invoice.invoice_id
+            with transaction.atomic():
+                # Activate the subscription and record its payment reference
+                if payment_invoice.subscription:
+                    payment_invoice.subscription.activate(
+                        payment_reference=payment_invoice.purchase_id
+                        or payment_invoice.invoice_id
+                    )
+
+                # Merge the webhook details into metadata on the database side
+                # so concurrent deliveries don't overwrite each other's keys
+                now = django_timezone.now()
+                PaymentInvoice.objects.filter(pk=payment_invoice.pk).update(
+                    status="finished",
+                    paid_at=now,
+                    updated_at=now,
+                    metadata=JSONBMerge(
+                        "metadata",
+                        {
+                            "webhook_received_at": now.isoformat(),
+                            "last_webhook": {
+                                key: webhook_data[key]
+                                for key in WEBHOOK_METADATA_KEYS
+                                if key in webhook_data
+                            },
+                        },
+                    ),
                 )
-                payment_invoice.subscription.save()
-
-            payment_invoice.status = "finished"
-            payment_invoice.paid_at = django_timezone.now()
-            payment_invoice.save()
             return True
 
-        except Exception as e:
+        except DatabaseError:
+            # Let process_payment_webhook retry it
+            raise
+        except Exception:
             # Log the error but don't raise it to avoid webhook failures
-            print(f"Error processing webhook data: {str(e)}")
+            logger.exception("Error processing webhook data")
             return False
 
 
-# Singleton instance
-payment_service = CoinPaymentService()
+@cache
+def get_payment_service() -> CoinPaymentService:
+    """Shared service instance, built on first use rather than at import."""
+    return CoinPaymentService()
@@ -0,0 +1,144 @@
+import time
+from smtplib import SMTPException
+
+import orjson
+from celery import shared_task
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import DatabaseError
+from django.utils import timezone
+
+from reusable.other import REDIS_CLIENT, only_one_concurrency
+from . import models
+from .services import get_payment_service
+
+logger = get_task_logger(__name__)
+
+EMAIL_OUTBOX_KEY = "user:email_outbox"
+# Seconds to wait before flushing, so emails requested together are batched
+EMAIL_OUTBOX_DELAY = 2
+EMAIL_OUTBOX_CHUNK_SIZE = 50
+EMAIL_MAX_ATTEMPTS = 3
+# Failed emails wait here, scored by the time of their next attempt
+EMAIL_RETRY_KEY = "user:email_retry"
+# Seconds before the first retry of a failed email, doubled for each next one
+EMAIL_RETRY_BACKOFF = 60
+
+
+@shared_task
+def expire_premium_flags():
+    """Clear the denormalized premium flags of profiles whose premium ended."""
+    count = models.Profile.objects.filter(
+        is_premium=True, premium_until__lte=timezone.now()
+    ).update(is_premium=False, premium_until=None)
+    logger.info("expire_premium_flags: %s profile(s) expired", count)
+
+
+@shared_task(
+    queue=settings.PAYMENT_WEBHOOK_QUEUE,
+    autoretry_for=(DatabaseError,),
+    retry_kwargs={"max_retries": 5},
+    retry_backoff=5,
+    retry_jitter=True,
+)
+def process_payment_webhook(webhook_data):
+    """Apply a payment webhook that PaymentWebhookView already acknowledged."""
+    if not get_payment_service().process_webhook_data(webhook_data):
+        logger.warning(
+            "process_payment_webhook: order %s was not processed",
+            webhook_data.get("order_id"),
+        )
+
+
+def queue_email(subject, body, recipient):
+    """
+    Put an email on the outbox, flush_email_outbox sends it shortly after.
+    Emails that arrive close together share a single SMTP connection.
+    """
+    REDIS_CLIENT.rpush(
+        EMAIL_OUTBOX_KEY,
+        orjson.dumps({"subject": subject, "body": body, "to": recipient}),
+    )
+    flush_email_outbox.apply_async(countdown=EMAIL_OUTBOX_DELAY)
+
+
+def send_verification_email(email, code):
+    """Send verification code to user's email"""
+    subject = "Email Verification Code"
+    message = f"""
+    Your verification code is: {code}
+    
+    This code will expire in 10 minutes.
+    
+    If you didn't request this code, please ignore this email.
+    """
+    queue_email(subject, message, email)
+
+
+def _pop_outbox_chunk():
+    """Atomically take up to EMAIL_OUTBOX_CHUNK_SIZE emails off the outbox."""
+    pipe = REDIS_CLIENT.pipeline()
+    pipe.lrange(EMAIL_OUTBOX_KEY, 0, EMAIL_OUTBOX_CHUNK_SIZE - 1)
+    pipe.ltrim(EMAIL_OUTBOX_KEY, EMAIL_OUTBOX_CHUNK_SIZE, -1)
+    items, _ = pipe.execute()
+    return items
+
+
+def _requeue_due_retries():
+    """Move the failed emails whose backoff has passed back onto the outbox."""
+    due = REDIS_CLIENT.zrangebyscore(EMAIL_RETRY_KEY, "-inf", time.time())
+    if due:
+        pipe = REDIS_CLIENT.pipeline()
+        pipe.rpush(EMAIL_OUTBOX_KEY, *due)
+        pipe.zrem(EMAIL_RETRY_KEY, *due)
+        pipe.execute()
+
+
+def _schedule_retry(data):
+    """Retry a failed email after an exponential backoff, or give up on it."""
+    attempts = data.get("attempts", 0) + 1
+    if attempts >= EMAIL_MAX_ATTEMPTS:
+        logger.exception("flush_email_outbox: dropped email to %s", data["to"])
+        return
+    data["attempts"] = attempts
+    retry_at = time.time() + EMAIL_RETRY_BACKOFF * 2 ** (attempts - 1)
+    REDIS_CLIENT.zadd(EMAIL_RETRY_KEY, {orjson.dumps(data): retry_at})
+
+
+@shared_task(name="user.tasks.flush_email_outbox", queue=settings.EMAIL_QUEUE)
+@only_one_concurrency(key="email_outbox", timeout=5 * 60)
+def flush_email_outbox():
+    """Send the queued emails in chunks, each chunk over one SMTP connection."""
+    _requeue_due_retries()
+    if not REDIS_CLIENT.llen(EMAIL_OUTBOX_KEY):
+        return
+
+    from_email = f"Job AI Assistant <{settings.EMAIL_HOST_USER}>"
+    # Connect before popping, so nothing leaves the outbox when the server
+    # can't be reached
+    with get_connection(fail_silently=False) as connection:
+        while chunk := _pop_outbox_chunk():
+            for index, item in enumerate(chunk):
+                data = orjson.loads(item)
+                message = EmailMessage(
+                    data["subject"],
+                    data["body"],
+                    from_email,
+                    [data["to"]],
+                    connection=connection,
+                )
+                try:
+                    message.send()
+                except (SMTPException, OSError):
+                    _schedule_retry(data)
+                    # The server is likely down: put the untried emails back
+                    # in order and leave them to a later run
+                    untried = chunk[index + 1 :]
+                    if untried:
+                        REDIS_CLIENT.lpush(EMAIL_OUTBOX_KEY, *reversed(untried))
+                    logger.warning(
+                        "flush_email_outbox: send failed, %s email(s) left queued",
+                        len(untried),
+                    )
+                    return
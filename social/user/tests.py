@@ -1,3 +1,554 @@
-from django.test import TestCase
+import time
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from smtplib import SMTPException
+from unittest import mock
 
-# Create your tests here.
+import orjson
+from django.contrib.admin.sites import AdminSite
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .admin import SubscriptionAdmin
+from .models import PaymentInvoice, Profile, Subscription, SubscriptionPlan
+from .services import CoinPaymentService
+from .tasks import (EMAIL_MAX_ATTEMPTS, EMAIL_OUTBOX_KEY, EMAIL_RETRY_BACKOFF,
+                    EMAIL_RETRY_KEY, expire_premium_flags, flush_email_outbox,
+                    process_payment_webhook)
+
+User = get_user_model()
+
+# The model signals and views cache in Redis, keep tests off it
+LOCMEM_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+}
+
+
+def create_profile(email="user@example.com"):
+    # The user_created receiver adds the profile
+    return User.objects.create(email=email, username=email).profile
+
+
+def create_plan(**kwargs):
+    defaults = {
+        "name": "Premium",
+        "plan_type": "monthly",
+        "price": Decimal("10.00"),
+        "duration_days": 30,
+    }
+    defaults.update(kwargs)
+    return SubscriptionPlan.objects.create(**defaults)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PremiumFlagsTests(TestCase):
+    def setUp(self):
+        self.profile = create_profile()
+        self.plan = create_plan()
+
+    def create_subscription(self, **kwargs):
+        return Subscription.objects.create(
+            profile=self.profile, plan=self.plan, **kwargs
+        )
+
+    def test_activate_sets_premium_flags(self):
+        subscription = self.create_subscription()
+        subscription.activate()
+
+        self.profile.refresh_from_db()
+        self.assertTrue(self.profile.is_premium)
+        self.assertEqual(self.profile.premium_until, subscription.expires_at)
+        self.assertTrue(self.profile.has_active_premium_subscription())
+
+    def test_cancel_clears_premium_flags(self):
+        subscription = self.create_subscription()
+        subscription.activate()
+        subscription.cancel()
+
+        self.profile.refresh_from_db()
+        self.assertFalse(self.profile.is_premium)
+        self.assertIsNone(self.profile.premium_until)
+
+    def test_admin_delete_clears_premium_flags(self):
+        subscription = self.create_subscription()
+        subscription.activate()
+
+        SubscriptionAdmin(Subscription, AdminSite()).delete_model(None, subscription)
+
+        self.profile.refresh_from_db()
+        self.assertFalse(self.profile.is_premium)
+        self.assertIsNone(self.profile.premium_until)
+
+    def test_admin_bulk_delete_keeps_remaining_subscription(self):
+        kept = self.create_subscription()
+        kept.activate()
+        extra = self.create_subscription(status="cancelled", is_active=False)
+
+        SubscriptionAdmin(Subscription, AdminSite()).delete_queryset(
+            None, Subscription.objects.filter(pk=extra.pk)
+        )
+
+        self.profile.refresh_from_db()
+        self.assertTrue(self.profile.is_premium)
+        self.assertEqual(self.profile.premium_until, kept.expires_at)
+
+    def test_expire_premium_flags_clears_ended_premium(self):
+        ended = timezone.now() - timedelta(minutes=1)
+        Profile.objects.filter(pk=self.profile.pk).update(
+            is_premium=True, premium_until=ended
+        )
+        running = create_profile("running@example.com")
+        Profile.objects.filter(pk=running.pk).update(
+            is_premium=True, premium_until=timezone.now() + timedelta(days=1)
+        )
+
+        expire_premium_flags()
+
+        self.profile.refresh_from_db()
+        self.assertFalse(self.profile.is_premium)
+        self.assertIsNone(self.profile.premium_until)
+        running.refresh_from_db()
+        self.assertTrue(running.is_premium)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class VerificationCodeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.profile = create_profile()
+
+    def test_issued_code_is_stored_hashed(self):
+        code = Profile.issue_verification_code(self.profile.user_id)
+
+        self.profile.refresh_from_db()
+        self.assertNotEqual(self.profile.verification_code_hash, code)
+        self.assertEqual(
+            self.profile.verification_code_hash, Profile.hash_verification_code(code)
+        )
+        self.assertTrue(self.profile.check_verification_code(code))
+        self.assertFalse(self.profile.check_verification_code(code[::-1] + "0"))
+        self.assertFalse(self.profile.is_verification_expired())
+
+    def test_issue_creates_missing_profile(self):
+        user = User.objects.create(email="new@example.com", username="new@example.com")
+        Profile.objects.filter(user=user).delete()
+
+        code = Profile.issue_verification_code(user.pk)
+
+        self.assertTrue(Profile.objects.get(user=user).check_verification_code(code))
+
+    def test_issue_resets_attempts(self):
+        Profile.objects.filter(pk=self.profile.pk).update(verification_attempts=3)
+
+        Profile.issue_verification_code(self.profile.user_id)
+
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.verification_attempts, 0)
+
+    def test_attempts_are_counted_in_the_database(self):
+        Profile.issue_verification_code(self.profile.user_id)
+        stale = Profile.objects.get(pk=self.profile.pk)
+
+        self.profile.increment_verification_attempts()
+        stale.increment_verification_attempts()
+        self.profile.increment_verification_attempts()
+
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.verification_attempts, 3)
+        self.assertFalse(self.profile.can_attempt_verification())
+
+    def test_correct_code_is_refused_after_max_attempts(self):
+        code = Profile.issue_verification_code(self.profile.user_id)
+        wrong = f"{(int(code) + 1) % 1000000:06d}"
+        client = APIClient()
+        url = reverse("user:verify_email_code")
+        email = self.profile.user.email
+
+        for _ in range(3):
+            response = client.post(url, {"email": email, "code": wrong}, format="json")
+            self.assertEqual(response.status_code, 400)
+        response = client.post(url, {"email": email, "code": code}, format="json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Too many failed attempts", response.data["error"])
+        self.profile.refresh_from_db()
+        self.assertFalse(self.profile.is_email_verified)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class VerificationThrottleTests(TestCase):
+    def setUp(self):
+        # Throttle history lives in the cache
+        cache.clear()
+        self.client = APIClient()
+        self.profile = create_profile()
+
+    @mock.patch("user.views.send_verification_email")
+    def test_request_is_throttled_per_email(self, send):
+        url = reverse("user:request_email_verification")
+        email = self.profile.user.email
+
+        for _ in range(3):
+            response = self.client.post(url, {"email": email}, format="json")
+            self.assertEqual(response.status_code, 200)
+        # Case and surrounding spaces don't give a fresh budget
+        response = self.client.post(
+            url, {"email": f" {email.upper()} "}, format="json"
+        )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(send.call_count, 3)
+
+    @mock.patch("user.views.send_verification_email")
+    def test_request_is_throttled_per_ip_when_authenticated(self, send):
+        url = reverse("user:request_email_verification")
+        self.client.force_authenticate(self.profile.user)
+
+        for index in range(10):
+            response = self.client.post(
+                url, {"email": f"user{index}@example.com"}, format="json"
+            )
+            self.assertEqual(response.status_code, 200)
+        response = self.client.post(url, {"email": "last@example.com"}, format="json")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(send.call_count, 10)
+
+    @mock.patch("user.views.send_verification_email")
+    def test_request_rejects_non_object_body(self, send):
+        url = reverse("user:request_email_verification")
+
+        for body in (["user@example.com"], "user@example.com"):
+            response = self.client.post(url, body, format="json")
+            self.assertEqual(response.status_code, 400)
+        send.assert_not_called()
+
+    def test_confirm_is_throttled_per_email(self):
+        url = reverse("user:verify_email_code")
+        body = {"email": self.profile.user.email, "code": "000000"}
+
+        for _ in range(5):
+            response = self.client.post(url, body, format="json")
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, body, format="json")
+
+        self.assertEqual(response.status_code, 429)
+        # Another address has its own budget
+        body["email"] = "other@example.com"
+        self.assertEqual(self.client.post(url, body, format="json").status_code, 400)
+
+    def test_confirm_rejects_list_body(self):
+        response = self.client.post(
+            reverse("user:verify_email_code"),
+            [{"email": self.profile.user.email, "code": "000000"}],
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class PaymentWebhookTests(TestCase):
+    def setUp(self):
+        self.profile = create_profile()
+        self.subscription = Subscription.objects.create(
+            profile=self.profile, plan=create_plan()
+        )
+        self.invoice = PaymentInvoice.objects.create(
+            profile=self.profile,
+            subscription=self.subscription,
+            order_id="sub_1_abcd",
+            invoice_id="inv_1",
+            price_amount=Decimal("10.00"),
+            status="waiting",
+        )
+        self.webhook_data = {"order_id": "sub_1_abcd", "status": "finished"}
+
+    def test_view_acknowledges_and_enqueues(self):
+        with mock.patch.object(process_payment_webhook, "delay") as delay:
+            response = APIClient().post(
+                reverse("user:payment_webhook"), self.webhook_data, format="json"
+            )
+
+        self.assertEqual(response.status_code, 202)
+        delay.assert_called_once_with(self.webhook_data)
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.status, "waiting")
+
+    def test_view_rejects_list_body(self):
+        with mock.patch.object(process_payment_webhook, "delay") as delay:
+            response = APIClient().post(
+                reverse("user:payment_webhook"), [self.webhook_data], format="json"
+            )
+
+        self.assertEqual(response.status_code, 400)
+        delay.assert_not_called()
+
+    def test_task_finishes_invoice_and_activates_subscription(self):
+        process_payment_webhook.apply(args=[self.webhook_data]).get()
+
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.status, "finished")
+        self.assertIsNotNone(self.invoice.paid_at)
+        self.assertEqual(self.invoice.metadata["last_webhook"]["status"], "finished")
+        self.subscription.refresh_from_db()
+        self.assertTrue(self.subscription.is_active)
+        self.assertEqual(self.subscription.status, "active")
+        self.assertEqual(self.subscription.payment_reference, "inv_1")
+        self.profile.refresh_from_db()
+        self.assertTrue(self.profile.is_premium)
+
+    def test_task_retries_database_errors(self):
+        with mock.patch.object(
+            CoinPaymentService, "process_webhook_data", side_effect=DatabaseError
+        ) as process:
+            result = process_payment_webhook.apply(args=[self.webhook_data])
+
+        self.assertIsInstance(result.result, DatabaseError)
+        max_retries = process_payment_webhook.retry_kwargs["max_retries"]
+        self.assertEqual(process.call_count, max_retries + 1)
+
+
+class FakeRedis:
+    """In-memory stand-in for the Redis commands the email outbox uses."""
+
+    def __init__(self):
+        self.lists = defaultdict(list)
+        self.zsets = defaultdict(dict)
+
+    def rpush(self, key, *values):
+        self.lists[key].extend(values)
+
+    def lpush(self, key, *values):
+        for value in values:
+            self.lists[key].insert(0, value)
+
+    def lrange(self, key, start, end):
+        return self.lists[key][start : None if end == -1 else end + 1]
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lrange(key, start, end)
+
+    def llen(self, key):
+        return len(self.lists[key])
+
+    def zadd(self, key, mapping):
+        self.zsets[key].update(mapping)
+
+    def zrangebyscore(self, key, low, high):
+        low, high = float(low), float(high)
+        items = sorted(self.zsets[key].items(), key=lambda item: item[1])
+        return [member for member, score in items if low <= score <= high]
+
+    def zrem(self, key, *members):
+        for member in members:
+            self.zsets[key].pop(member, None)
+
+    def lock(self, *args, **kwargs):
+        return mock.MagicMock()
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name, args))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args) for name, args in self.calls]
+
+
+class FailingEmailBackend(EmailBackend):
+    """locmem backend whose SMTP server is down for one recipient."""
+
+    failing_recipient = "down@example.com"
+
+    def send_messages(self, messages):
+        if any(self.failing_recipient in message.to for message in messages):
+            raise SMTPException("Connection unexpectedly closed")
+        return super().send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND="user.tests.FailingEmailBackend")
+class EmailOutboxTests(TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        # The concurrency lock takes the client from reusable.other
+        for target in ("user.tasks.REDIS_CLIENT", "reusable.other.REDIS_CLIENT"):
+            patcher = mock.patch(target, self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def email(self, recipient, **extra):
+        return orjson.dumps({"subject": "Hi", "body": "Hi", "to": recipient, **extra})
+
+    def outbox(self):
+        return [orjson.loads(item)["to"] for item in self.redis.lists[EMAIL_OUTBOX_KEY]]
+
+    def test_failed_email_moves_to_retry_set(self):
+        for recipient in ("a@example.com", "down@example.com", "b@example.com"):
+            self.redis.rpush(EMAIL_OUTBOX_KEY, self.email(recipient))
+
+        before = time.time()
+        flush_email_outbox()
+
+        self.assertEqual([message.to for message in mail.outbox], [["a@example.com"]])
+        ((item, retry_at),) = self.redis.zsets[EMAIL_RETRY_KEY].items()
+        self.assertEqual(orjson.loads(item)["to"], "down@example.com")
+        self.assertEqual(orjson.loads(item)["attempts"], 1)
+        self.assertGreaterEqual(retry_at, before + EMAIL_RETRY_BACKOFF)
+
+    def test_untried_emails_are_requeued_in_order(self):
+        recipients = ["down@example.com", "b@example.com", "c@example.com"]
+        for recipient in recipients:
+            self.redis.rpush(EMAIL_OUTBOX_KEY, self.email(recipient))
+        self.redis.rpush(EMAIL_OUTBOX_KEY, self.email("d@example.com"))
+
+        with mock.patch("user.tasks.EMAIL_OUTBOX_CHUNK_SIZE", 3):
+            flush_email_outbox()
+
+        self.assertEqual(mail.outbox, [])
+        # Put back in front of the emails that were never popped
+        self.assertEqual(
+            self.outbox(), ["b@example.com", "c@example.com", "d@example.com"]
+        )
+
+    def test_due_retry_is_sent(self):
+        self.redis.zadd(
+            EMAIL_RETRY_KEY, {self.email("a@example.com", attempts=1): time.time() - 1}
+        )
+
+        flush_email_outbox()
+
+        self.assertEqual([message.to for message in mail.outbox], [["a@example.com"]])
+        self.assertEqual(self.redis.zsets[EMAIL_RETRY_KEY], {})
+        self.assertEqual(self.outbox(), [])
+
+    def test_email_is_dropped_after_max_attempts(self):
+        item = self.email("down@example.com", attempts=EMAIL_MAX_ATTEMPTS - 1)
+        self.redis.zadd(EMAIL_RETRY_KEY, {item: time.time() - 1})
+
+        flush_email_outbox()
+
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(self.redis.zsets[EMAIL_RETRY_KEY], {})
+        self.assertEqual(self.outbox(), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MigrationTestCase(TransactionTestCase):
+    """Migrate the user app to migrate_from, add rows, then go to migrate_to."""
+
+    migrate_from = None
+    migrate_to = None
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate([("user", self.migrate_from)])
+        old_apps = executor.loader.project_state([("user", self.migrate_from)]).apps
+        self.set_up_before_migration(old_apps)
+
+        executor = MigrationExecutor(connection)
+        executor.migrate([("user", self.migrate_to)])
+        self.apps = executor.loader.project_state([("user", self.migrate_to)]).apps
+
+    def tearDown(self):
+        # Leave the schema fully migrated for the other tests
+        call_command("migrate", verbosity=0)
+
+    def set_up_before_migration(self, apps):
+        pass
+
+
+class PremiumFlagsBackfillTests(MigrationTestCase):
+    migrate_from = "0013_paymentinvoice_invoice_profile_status_idx_and_more"
+    migrate_to = "0014_profile_is_premium_profile_premium_until"
+
+    def set_up_before_migration(self, apps):
+        user_model = apps.get_model("auth", "User")
+        profile_model = apps.get_model("user", "Profile")
+        plan_model = apps.get_model("user", "SubscriptionPlan")
+        subscription_model = apps.get_model("user", "Subscription")
+
+        plan = plan_model.objects.create(
+            name="Premium", plan_type="monthly", price=Decimal("10"), duration_days=30
+        )
+        now = timezone.now()
+        self.premium_until = now + timedelta(days=20)
+
+        def profile(email):
+            user = user_model.objects.create(email=email, username=email)
+            return profile_model.objects.create(user=user)
+
+        self.premium_id = profile("premium@example.com").pk
+        for expires_at in (now + timedelta(days=5), self.premium_until):
+            subscription_model.objects.create(
+                profile_id=self.premium_id,
+                plan=plan,
+                status="active",
+                expires_at=expires_at,
+            )
+
+        self.expired_id = profile("expired@example.com").pk
+        subscription_model.objects.create(
+            profile_id=self.expired_id,
+            plan=plan,
+            status="active",
+            expires_at=now - timedelta(days=1),
+        )
+        self.cancelled_id = profile("cancelled@example.com").pk
+        subscription_model.objects.create(
+            profile_id=self.cancelled_id,
+            plan=plan,
+            status="cancelled",
+            is_active=False,
+            expires_at=self.premium_until,
+        )
+
+    def test_backfills_premium_flags_from_active_subscriptions(self):
+        profile_model = self.apps.get_model("user", "Profile")
+
+        premium = profile_model.objects.get(pk=self.premium_id)
+        self.assertTrue(premium.is_premium)
+        self.assertEqual(premium.premium_until, self.premium_until)
+        for pk in (self.expired_id, self.cancelled_id):
+            profile = profile_model.objects.get(pk=pk)
+            self.assertFalse(profile.is_premium)
+            self.assertIsNone(profile.premium_until)
+
+
+class VerificationCodeHashMigrationTests(MigrationTestCase):
+    migrate_from = "0014_profile_is_premium_profile_premium_until"
+    migrate_to = "0015_profile_verification_code_hash"
+
+    def set_up_before_migration(self, apps):
+        user_model = apps.get_model("auth", "User")
+        profile_model = apps.get_model("user", "Profile")
+        user = user_model.objects.create(
+            email="user@example.com", username="user@example.com"
+        )
+        self.profile_id = profile_model.objects.create(
+            user=user, verification_code="123456"
+        ).pk
+
+    def test_existing_codes_still_verify(self):
+        profile_model = self.apps.get_model("user", "Profile")
+        stored = profile_model.objects.get(pk=self.profile_id).verification_code_hash
+
+        self.assertNotEqual(stored, "123456")
+        self.assertEqual(stored, Profile.hash_verification_code("123456"))
@@ -0,0 +1,52 @@
+from hashlib import sha1
+
+from rest_framework.throttling import SimpleRateThrottle
+
+
+class VerificationRequestIPThrottle(SimpleRateThrottle):
+    """Limit how many verification codes one client IP can request."""
+
+    scope = "verification_ip"
+    rate = "10/min"
+
+    def get_cache_key(self, request, view):
+        # Unlike AnonRateThrottle, authenticated callers are counted too
+        return self.cache_format % {
+            "scope": self.scope,
+            "ident": self.get_ident(request),
+        }
+
+
+class EmailRateThrottle(SimpleRateThrottle):
+    """Throttle by the email address in the request body, whoever sends it."""
+
+    def parse_rate(self, rate):
+        # DRF only accepts a bare unit as the period, allow e.g. "10m" as well
+        num, period = rate.split("/")
+        units = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+        return int(num), int(period[:-1] or 1) * units[period[-1]]
+
+    def get_cache_key(self, request, view):
+        # Runs before validation, the body may be a JSON list or scalar
+        if not isinstance(request.data, dict):
+            return None
+        email = request.data.get("email")
+        if not isinstance(email, str):
+            # Rejected by the serializer anyway
+            return None
+        ident = sha1(email.strip().casefold().encode()).hexdigest()
+        return self.cache_format % {"scope": self.scope, "ident": ident}
+
+
+class VerificationRequestEmailThrottle(EmailRateThrottle):
+    """Limit how many verification codes are sent to one email address."""
+
+    scope = "verification_email"
+    rate = "3/10m"
+
+
+class VerificationConfirmEmailThrottle(EmailRateThrottle):
+    """Limit how often codes can be tried against one email address."""
+
+    scope = "verification_confirm_email"
+    rate = "5/10m"
@@ -1,8 +1,13 @@
 import logging
+import math
+import time
+from hashlib import blake2b
 
-from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, QueryDict
+from django.utils import timezone
 from network.views import ListPagination
 from rest_framework import status
 from rest_framework.authentication import SessionAuthentication
@@ -10,50 +15,46 @@ from rest_framework.generics import ListAPIView
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import \
     TokenRefreshView as DRFTokenRefreshView
 
-from .models import (FeatureUsage, PaymentInvoice, Profile, Subscription,
-                     SubscriptionPlan)
+from reusable.renderers import ORJSONRenderer
+from .authentication import ProfileJWTAuthentication
+from .models import (PLAN_CACHE_TIMEOUT, PREMIUM_STATUS_CACHE_TIMEOUT,
+                     FeatureUsage, PaymentInvoice, Profile, Subscription,
+                     SubscriptionPlan, premium_status_cache_key)
 from .serializers import (EmailVerificationConfirmSerializer,
                           EmailVerificationRequestSerializer,
                           FeatureUsageSerializer, PaymentInvoiceSerializer,
                           ProfileSerializer, SubscriptionPlanSerializer,
                           SubscriptionSerializer, UserRegistrationSerializer,
                           UserSerializer)
-from .services import payment_service
+from .services import PaymentServiceError, get_payment_service
+from .tasks import process_payment_webhook, send_verification_email
+from .throttles import (VerificationConfirmEmailThrottle,
+                        VerificationRequestEmailThrottle,
+                        VerificationRequestIPThrottle)
 
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
-
-def send_verification_email(email, code):
-    """Send verification code to user's email"""
-    subject = "Email Verification Code"
-    message = f"""
-    Your verification code is: {code}
-    
-    This code will expire in 10 minutes.
-    
-    If you didn't request this code, please ignore this email.
-    """
-
-    send_mail(
-        subject,
-        message,
-        f"Job AI Assistant <{settings.EMAIL_HOST_USER}>",
-        [email],
-        fail_silently=False,
-    )
+# Seconds a refresh response is reused for the same refresh token
+REFRESH_RESPONSE_CACHE_TIMEOUT = 60
 
 
 class RequestEmailVerificationView(APIView):
     """Request email verification code"""
 
     permission_classes = [AllowAny]
+    # Checked before the body is validated, so abuse is turned away with a
+    # cache lookup instead of user writes and emails
+    throttle_classes = [
+        VerificationRequestIPThrottle,
+        VerificationRequestEmailThrottle,
+    ]
 
     def post(self, request):
         serializer = EmailVerificationRequestSerializer(data=request.data)
@@ -62,35 +63,31 @@ class RequestEmailVerificationView(APIView):
 
         email = serializer.validated_data["email"]
 
-        # Get or create user and profile
-        user, created = User.objects.get_or_create(
-            email=email, defaults={"username": email, "is_active": True}
-        )
-
-        profile, profile_created = Profile.objects.get_or_create(user=user)
-
-        # Reset verification code for existing profiles
-        if not profile_created:
-            profile.reset_verification_code()
-
-        # Send email
-        try:
-            send_verification_email(email, profile.verification_code)
-            return Response(
-                {"message": "Verification code sent successfully"},
-                status=status.HTTP_200_OK,
-            )
-        except Exception as e:
-            return Response(
-                {"error": "Failed to send verification email"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        # Only the hash of the code is stored, so keep the plain code around
+        # long enough to email it
+        with transaction.atomic():
+            # get_or_create() re-fetches when a concurrent first request for
+            # the same email wins the INSERT
+            user, _ = User.objects.only("id").get_or_create(
+                email=email, defaults={"username": email, "is_active": True}
             )
+            code = Profile.issue_verification_code(user.pk)
+
+        # Queued and sent by a worker so the response doesn't wait for SMTP
+        send_verification_email(email, code)
+        return Response(
+            {"message": "Verification code sent successfully"},
+            status=status.HTTP_200_OK,
+        )
 
 
 class VerifyEmailCodeView(APIView):
     """Verify email code and return JWT tokens"""
 
     permission_classes = [AllowAny]
+    # Guessing codes is stopped in the cache, before any profile is read or
+    # its attempt counter written
+    throttle_classes = [VerificationConfirmEmailThrottle]
 
     def post(self, request):
         serializer = EmailVerificationConfirmSerializer(data=request.data)
@@ -101,15 +98,21 @@ class VerifyEmailCodeView(APIView):
         code = serializer.validated_data["code"]
 
         try:
-            user = User.objects.get(email=email)
-            profile = user.profile
-        except User.DoesNotExist:
+            # One JOIN for both rows, limited to what the check, the tokens
+            # (RefreshToken.for_user() reads is_active) and UserSerializer read
+            user_fields = (f"user__{name}" for name in UserSerializer.Meta.fields)
+            profile = (
+                Profile.objects.with_user()
+                .only(*Profile.VERIFICATION_FIELDS, *user_fields, "user__is_active")
+                .get(user__email=email)
+            )
+        except Profile.DoesNotExist:
             return Response(
                 {"error": "User not found. Please request a verification code first."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        if not profile.verification_code or profile.verification_code != code:
+        if not profile.check_verification_code(code):
             profile.increment_verification_attempts()
             return Response(
                 {"error": "Invalid verification code"},
@@ -132,6 +135,7 @@ class VerifyEmailCodeView(APIView):
         profile.mark_email_as_verified()
 
         # Generate JWT tokens
+        user = profile.user
         refresh = RefreshToken.for_user(user)
         access_token = refresh.access_token
 
@@ -155,31 +159,26 @@ class RegisterUserView(APIView):
         serializer = UserRegistrationSerializer(data=request.data)
 
         serializer.is_valid(raise_exception=True)
+        user = serializer.save()
 
-        try:
-            user = serializer.save()
-
-            # Generate JWT tokens
-            refresh = RefreshToken.for_user(user)
-            access_token = refresh.access_token
-
-            return Response(
-                {
-                    "message": "User registered successfully",
-                    "user": UserSerializer(user).data,
-                    "tokens": {"access": str(access_token), "refresh": str(refresh)},
-                },
-                status=status.HTTP_201_CREATED,
-            )
+        # Generate JWT tokens
+        refresh = RefreshToken.for_user(user)
+        access_token = refresh.access_token
 
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(
+            {
+                "message": "User registered successfully",
+                "user": UserSerializer(user).data,
+                "tokens": {"access": str(access_token), "refresh": str(refresh)},
+            },
+            status=status.HTTP_201_CREATED,
+        )
 
 
 class UserProfileView(APIView):
     """Get current user profile"""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
@@ -190,23 +189,17 @@ class UserProfileView(APIView):
 class ProfileDetailView(APIView):
     """Get or update user profile"""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        try:
-            profile = request.user.profile
-        except Profile.DoesNotExist:
-            profile = Profile.objects.create(user=request.user)
+        profile = request.user.profile
 
         serializer = ProfileSerializer(profile)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     def put(self, request):
-        try:
-            profile = request.user.profile
-        except Profile.DoesNotExist:
-            profile = Profile.objects.create(user=request.user)
+        profile = request.user.profile
 
         serializer = ProfileSerializer(profile, data=request.data, partial=False)
         serializer.is_valid(raise_exception=True)
@@ -214,10 +207,7 @@ class ProfileDetailView(APIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     def patch(self, request):
-        try:
-            profile = request.user.profile
-        except Profile.DoesNotExist:
-            profile = Profile.objects.create(user=request.user)
+        profile = request.user.profile
 
         serializer = ProfileSerializer(profile, data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
@@ -239,16 +229,29 @@ class RefreshTokenView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        # Clients that poll get the same answer for a short while instead of
+        # verifying and signing tokens again; the key is only a cache lookup
+        token_hash = blake2b(str(refresh_token).encode(), digest_size=16)
+        cache_key = f"rt:{token_hash.hexdigest()}"
+        data = cache.get(cache_key)
+        if data is not None:
+            return Response(data, status=status.HTTP_200_OK)
+
         try:
             refresh = RefreshToken(refresh_token)
             access_token = refresh.access_token
 
-            return Response(
-                {"access": str(access_token), "refresh": str(refresh)},
-                status=status.HTTP_200_OK,
+            # Tokens aren't rotated, so the refresh token goes back unchanged
+            # rather than being signed again
+            data = {"access": str(access_token), "refresh": refresh_token}
+            cache.set(
+                cache_key,
+                data,
+                min(REFRESH_RESPONSE_CACHE_TIMEOUT, refresh["exp"] - int(time.time())),
             )
+            return Response(data, status=status.HTTP_200_OK)
 
-        except Exception as e:
+        except TokenError:
             return Response(
                 {"error": "Invalid refresh token"}, status=status.HTTP_400_BAD_REQUEST
             )
@@ -262,24 +265,45 @@ class TokenRefreshView(DRFTokenRefreshView):
 class SubscriptionPlansView(APIView):
     """Get all available subscription plans."""
 
+    # Public endpoint, don't spend a JWT decode and user lookup per request
+    authentication_classes = []
     permission_classes = [AllowAny]
 
     def get(self, request):
+        # The rendered JSON is cached under the plan cache version, so any
+        # plan change refreshes it and a hit does no ORM or rendering work
+        body = cache.get_or_set(
+            "plans:active:json",
+            self.render_plans,
+            PLAN_CACHE_TIMEOUT,
+            version=SubscriptionPlan.cache_version(),
+        )
+        return HttpResponse(body, content_type="application/json")
+
+    @staticmethod
+    def render_plans():
         plans = SubscriptionPlan.objects.filter(is_active=True).order_by("price")
-        serializer = SubscriptionPlanSerializer(plans, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return ORJSONRenderer().render(
+            SubscriptionPlanSerializer(plans, many=True).data
+        )
 
 
-class UserSubscriptionsView(APIView):
+class UserSubscriptionsView(ListAPIView):
     """Get user's subscriptions or create a new subscription."""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
+    serializer_class = SubscriptionSerializer
+    # A row per purchase, so the history grows without bound
+    pagination_class = ListPagination
 
-    def get(self, request):
-        subscriptions = Subscription.objects.filter(profile=request.user.profile)
-        serializer = SubscriptionSerializer(subscriptions, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    def get_queryset(self):
+        return (
+            Subscription.objects.filter(profile__user=self.request.user)
+            .select_related("plan")
+            .with_expiry()
+            .order_by("-created_at")
+        )
 
     def post(self, request):
         serializer = SubscriptionSerializer(
@@ -290,7 +314,7 @@ class UserSubscriptionsView(APIView):
 
             try:
                 # Create payment invoice using the payment service
-                payment_invoice = payment_service.create_invoice(
+                payment_invoice = get_payment_service().create_invoice(
                     profile=request.user.profile,
                     subscription=subscription,
                     price_amount=subscription.plan.price,
@@ -309,7 +333,7 @@ class UserSubscriptionsView(APIView):
                     status=status.HTTP_201_CREATED,
                 )
 
-            except Exception as e:
+            except PaymentServiceError as e:
                 # If payment service fails, delete the subscription and return error
                 subscription.delete()
                 return Response(
@@ -323,7 +347,7 @@ class UserSubscriptionsView(APIView):
 class CancelSubscriptionView(APIView):
     """Cancel a user's subscription."""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
 
     def post(self, request, subscription_id):
@@ -333,12 +357,7 @@ class CancelSubscriptionView(APIView):
             )
 
             # Cancel the subscription (this will also cancel associated payment invoices)
-            subscription.cancel()
-
-            # Get count of cancelled payment invoices for response
-            cancelled_invoices_count = subscription.payment_invoices.filter(
-                status="expired"
-            ).count()
+            cancelled_invoices_count = subscription.cancel()
 
             response_message = "Subscription cancelled successfully"
             if cancelled_invoices_count > 0:
@@ -354,21 +373,16 @@ class CancelSubscriptionView(APIView):
             return Response(
                 {"error": "Subscription not found"}, status=status.HTTP_404_NOT_FOUND
             )
-        except Exception as e:
-            return Response(
-                {"error": f"Failed to cancel subscription: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            )
 
 
 class FeatureUsageView(APIView):
     """Get user's premium feature usage statistics."""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        usage_stats = FeatureUsage.objects.filter(profile=request.user.profile)
+        usage_stats = FeatureUsage.objects.filter(profile__user=request.user)
         serializer = FeatureUsageSerializer(usage_stats, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -376,11 +390,22 @@ class FeatureUsageView(APIView):
 class PremiumStatusView(APIView):
     """Check if user has premium access and return subscription details."""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
         profile = request.user.profile
+        # Dropped by the Subscription post_save/post_delete receiver
+        cache_key = premium_status_cache_key(profile.pk)
+        data = cache.get(cache_key)
+        if data is None:
+            data, timeout = self.build_status(profile)
+            cache.set(cache_key, data, timeout)
+        return Response(data, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def build_status(profile):
+        """Return the status payload and how many seconds it stays correct."""
         latest_subscription = profile.get_latest_subscription()
 
         # Determine has_premium value: "active", "pending", or False
@@ -394,40 +419,55 @@ class PremiumStatusView(APIView):
             # For expired, cancelled, or any other status
             has_premium = False
 
+        timeout = PREMIUM_STATUS_CACHE_TIMEOUT
+        if latest_subscription:
+            # days_remaining drops at every whole day before expires_at, and
+            # at expires_at the subscription isn't the latest active one
+            remaining = latest_subscription.expires_at - timezone.now()
+            remaining = remaining.total_seconds()
+            timeout = max(1, min(timeout, math.ceil(remaining % (24 * 60 * 60))))
+
         data = {
             "has_premium": has_premium,
             "subscription": SubscriptionSerializer(latest_subscription).data
             if latest_subscription
             else None,
         }
-
-        return Response(data, status=status.HTTP_200_OK)
+        return data, timeout
 
 
 class PaymentInvoicesView(ListAPIView):
     """Get user's payment invoices."""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = PaymentInvoiceSerializer
     pagination_class = ListPagination
 
     def get_queryset(self):
-        return PaymentInvoice.objects.filter(
-            profile=self.request.user.profile
-        ).order_by("-created_at")
+        return (
+            PaymentInvoice.objects.filter(profile__user=self.request.user)
+            .select_related("subscription__plan")
+            .defer("metadata")
+            .with_expiry()
+            .order_by("-created_at")
+        )
 
 
 class PaymentInvoiceDetailView(APIView):
     """Get specific payment invoice details."""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request, order_id):
         try:
-            invoice = PaymentInvoice.objects.get(
-                order_id=order_id, profile=request.user.profile
+            # order_id is unique, so this is an index probe; the owner check
+            # joins the profile instead of loading it first
+            invoice = (
+                PaymentInvoice.objects.select_related("subscription__plan")
+                .with_expiry()
+                .get(order_id=order_id, profile__user=request.user)
             )
 
             serializer = PaymentInvoiceSerializer(invoice)
@@ -446,34 +486,29 @@ class PaymentWebhookView(APIView):
 
     def post(self, request):
         """Process payment webhook."""
-        try:
-            webhook_data = request.data
-
-            # Process the webhook data
-            success = payment_service.process_webhook_data(webhook_data)
-
-            if success:
-                return Response(
-                    {"message": "Webhook processed successfully"},
-                    status=status.HTTP_200_OK,
-                )
-            else:
-                return Response(
-                    {"error": "Failed to process webhook"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-
-        except Exception as e:
+        webhook_data = request.data
+        # Form-encoded deliveries parse into a QueryDict of lists, the task
+        # needs plain values
+        if isinstance(webhook_data, QueryDict):
+            webhook_data = webhook_data.dict()
+        if not isinstance(webhook_data, dict) or not webhook_data.get("order_id"):
             return Response(
-                {"error": f"Webhook processing error: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                {"error": "Failed to process webhook"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
+        # Acknowledge right away, the invoice and subscription are updated by
+        # a worker so the payment service doesn't time out and redeliver
+        process_payment_webhook.delay(webhook_data)
+        return Response(
+            {"message": "Webhook accepted"}, status=status.HTTP_202_ACCEPTED
+        )
+
 
 class CancelPaymentInvoiceView(APIView):
     """Cancel a specific payment invoice."""
 
-    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    authentication_classes = [ProfileJWTAuthentication, SessionAuthentication]
     permission_classes = [IsAuthenticated]
 
     def post(self, request, invoice_id):
@@ -518,8 +553,3 @@ class CancelPaymentInvoiceView(APIView):
                 {"error": "Payment invoice not found"},
                 status=status.HTTP_404_NOT_FOUND,
             )
-        except Exception as e:
-            return Response(
-                {"error": f"Failed to cancel payment: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            )